@@ -1,13 +1,24 @@
 import os
-import json
+import io
+import asyncio
+import orjson
+import hashlib
 import logging
+import time
+from contextvars import ContextVar
 import random
 import math
-from typing import Dict, Any, Optional
-from openai import OpenAI
-from music21 import converter, stream, instrument, tempo, meter, note, midi
+import re
+from dataclasses import dataclass, fields
+from fractions import Fraction
+from functools import lru_cache
+from typing import Dict, Any, Optional, List, Tuple, Callable
+import numpy as np
+import mido
+import httpx
+from openai import AsyncOpenAI
+from music21 import common, stream, instrument, tempo, meter, note, chord, key, pitch, tie, midi
 from dotenv import load_dotenv
-from copy import deepcopy
 
 load_dotenv()
 # Configure logging
@@ -19,10 +30,183 @@ if not os.getenv('OPENAI_API_KEY'):
     raise ValueError("OpenAI API key not found.")
 
 # Update the OpenAI client initialization
-client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+client = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
 
-def determine_musical_parameters(prompt: str) -> Dict[str, Any]:
-    system_prompt = """You are a professional music theorist and composer. Analyze the user's prompt and determine appropriate musical parameters for a polished, radio-ready production.
+# run() scopes one pooled HTTP/2 client to each song; everything else uses the default client
+_run_client: ContextVar[Optional[AsyncOpenAI]] = ContextVar('_run_client', default=None)
+
+def _make_http_client() -> httpx.AsyncClient:
+    # One HTTP/2 connection pool keeps TLS sessions warm across the concurrent part requests
+    return httpx.AsyncClient(
+        http2=True,
+        timeout=60,
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=32)
+    )
+
+def _openai() -> AsyncOpenAI:
+    return _run_client.get() or client
+
+# Maximum number of instrument parts requested from the API at once
+MAX_CONCURRENT_PARTS = 3
+
+# On-disk cache for chat completions, keyed by model, messages and sampling params
+CACHE_DIR = os.path.expanduser(os.getenv('SPOTIFAI_CACHE_DIR', '~/.cache/spotifai'))
+CACHE_TTL = int(os.getenv('SPOTIFAI_CACHE_TTL', str(7 * 24 * 3600)))  # seconds, 0 disables expiry
+
+# Semantic cache: reuse a completion when a re-phrased prompt embeds close enough
+EMBEDDING_MODEL = 'text-embedding-3-small'
+SEMANTIC_THRESHOLD = float(os.getenv('SPOTIFAI_SEMANTIC_THRESHOLD', '0.92'))
+SEMANTIC_MAX_ROWS = int(os.getenv('SPOTIFAI_SEMANTIC_MAX_ROWS', '1000'))  # newest rows kept per context
+
+def _hash_key(payload: Dict[str, Any]) -> str:
+    return hashlib.sha256(orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+def _is_fresh(created: float) -> bool:
+    return not CACHE_TTL or time.time() - created < CACHE_TTL
+
+async def _embed(text: str) -> np.ndarray:
+    response = await _openai().embeddings.create(model=EMBEDDING_MODEL, input=text)
+    return np.asarray(response.data[0].embedding, dtype=np.float32)
+
+def _semantic_paths(context_key: str) -> Tuple[str, str]:
+    base = os.path.join(CACHE_DIR, 'semantic', context_key)
+    return f"{base}.npy", f"{base}.json"
+
+def _semantic_load(context_key: str) -> Tuple[np.ndarray, List[Dict[str, Any]]]:
+    # Returns the fresh rows only; a partially written pair is trimmed to the rows both files share
+    emb_path, resp_path = _semantic_paths(context_key)
+    try:
+        cached_embs = np.load(emb_path)
+        with open(resp_path, 'rb') as f:
+            rows = orjson.loads(f.read())
+    except (OSError, ValueError):
+        return np.empty((0, 0), dtype=np.float32), []
+    if cached_embs.ndim != 2 or not isinstance(rows, list):
+        return np.empty((0, 0), dtype=np.float32), []
+
+    count = min(len(cached_embs), len(rows))
+    keep = [i for i in range(count)
+            if isinstance(rows[i], dict) and 'content' in rows[i] and _is_fresh(rows[i].get('created', 0))]
+    return cached_embs[keep], [rows[i] for i in keep]
+
+def _semantic_lookup(context_key: str, query: np.ndarray) -> Optional[str]:
+    cached_embs, rows = _semantic_load(context_key)
+    if not rows or cached_embs.shape[1] != query.shape[0]:
+        return None
+
+    norms = np.linalg.norm(cached_embs, axis=1) * np.linalg.norm(query)
+    sims = cached_embs @ query / np.maximum(norms, 1e-12)
+    best = int(np.argmax(sims))
+    if sims[best] <= SEMANTIC_THRESHOLD:
+        return None
+    logging.debug(f"Semantic cache hit ({sims[best]:.3f}) for {context_key}")
+    return rows[best]['content']
+
+def _atomic_write(path: str, data: bytes) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def _semantic_store(context_key: str, query: np.ndarray, content: str) -> None:
+    emb_path, resp_path = _semantic_paths(context_key)
+    cached_embs, rows = _semantic_load(context_key)
+    if not rows or cached_embs.shape[1] != query.shape[0]:
+        cached_embs, rows = np.empty((0, query.shape[0]), dtype=np.float32), []
+
+    cached_embs = np.vstack([cached_embs, query[np.newaxis, :]])[-SEMANTIC_MAX_ROWS:]
+    rows = (rows + [{'created': time.time(), 'content': content}])[-SEMANTIC_MAX_ROWS:]
+
+    try:
+        os.makedirs(os.path.dirname(emb_path), exist_ok=True)
+        emb_buffer = io.BytesIO()
+        np.save(emb_buffer, cached_embs)
+        _atomic_write(emb_path, emb_buffer.getvalue())
+        _atomic_write(resp_path, orjson.dumps(rows))
+    except OSError as e:
+        logging.warning(f"Could not write semantic cache: {e}")
+
+async def _stream_chat(model: str, messages: List[Dict[str, str]],
+                       stop_when: Callable[[str], bool], lookback: int = 0, **kw) -> Tuple[str, bool]:
+    # Returns the text received so far and whether stop_when cut the stream short.
+    # stop_when only sees the new delta plus `lookback` preceding characters, so
+    # the check stays linear in the response length.
+    response = await _openai().chat.completions.create(model=model, messages=messages, stream=True, **kw)
+    text = ''
+    async for chunk in response:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if not delta:
+            continue
+        text += delta
+        if stop_when(text[-(len(delta) + lookback):]):
+            await response.close()
+            return text, True
+    return text, False
+
+async def _cached_chat(model: str, messages: List[Dict[str, str]], semantic: bool = False,
+                       stop_when: Optional[Callable[[str], bool]] = None,
+                       stop_lookback: int = 0, **kw) -> str:
+    # With semantic=True the final (user) message is matched by embedding
+    # similarity among requests that share the same model, system messages and params.
+    # With stop_when the completion is streamed and abandoned (and not cached)
+    # as soon as stop_when returns True for the latest delta plus stop_lookback
+    # characters before it.
+    key = _hash_key({"m": model, "msgs": messages, "kw": kw})
+    path = os.path.join(CACHE_DIR, f"{key}.json")
+
+    try:
+        with open(path, 'rb') as f:
+            entry = orjson.loads(f.read())
+        if _is_fresh(entry['created']):
+            logging.debug(f"Cache hit for {key}")
+            return entry['content']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    query = None
+    if semantic:
+        context_key = _hash_key({"m": model, "msgs": messages[:-1], "kw": kw})
+        try:
+            query = await _embed(messages[-1]['content'])
+            content = _semantic_lookup(context_key, query)
+            if content is not None:
+                return content
+        except Exception as e:
+            logging.warning(f"Semantic cache unavailable: {e}")
+            query = None
+
+    if stop_when is not None:
+        content, stopped = await _stream_chat(model, messages, stop_when, stop_lookback, **kw)
+        if stopped:
+            return content
+    else:
+        response = await _openai().chat.completions.create(model=model, messages=messages, **kw)
+        message = response.choices[0].message
+        if message.tool_calls:
+            # Tool-call answers are returned as a JSON object of raw arguments keyed by function name
+            content = orjson.dumps({call.function.name: call.function.arguments for call in message.tool_calls}).decode('utf-8')
+        else:
+            content = message.content or ''
+            if 'tools' in kw:
+                # A tool request answered in plain text is a miss; let the next run retry it
+                return content
+
+    if query is not None:
+        _semantic_store(context_key, query, content)
+
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        _atomic_write(path, orjson.dumps({'created': time.time(), 'model': model, 'content': content}))
+    except OSError as e:
+        logging.warning(f"Could not write completion cache: {e}")
+
+    return content
+
+# System prompts are module-level constants so their bytes are identical across
+# calls, which lets OpenAI's automatic prompt caching reuse the shared prefix.
+PARAMETERS_SYSTEM_PROMPT = """You are a professional music theorist and composer. Analyze the user's prompt and determine appropriate musical parameters for a polished, radio-ready production.
 
 Return ONLY a valid JSON object with these parameters (no comments):
 {
@@ -36,24 +220,133 @@ Return ONLY a valid JSON object with these parameters (no comments):
     "style": "<musical style>"
 }
 """
+
+INSTRUMENTS_SYSTEM_PROMPT = """You are a music arranger for a polished, radio-ready production. Analyze the prompt and choose appropriate instruments to create a rich, balanced track.
+
+Return ONLY a valid JSON object with instrument groups and their MIDI channels. Format:
+{
+    "rhythm": [["DrumSet", 10], ["ElectricBass", 1]],
+    "harmony": [["Piano", 2]],
+    "lead": [["SynthLead", 3]],
+    "accompaniment": [["Violin", 4]],
+    "backing_vocals": [["VoiceOohs", 5]]
+}
+
+DrumSet must always use channel 10.
+"""
+
+MUSIC_SYSTEM_PROMPT = """You are a professional music composer creating valid ABC notation for a polished, radio-ready song. Follow these requirements strictly:
+
+1. Compose music that follows the requested scale and the given chord progression.
+2. Match the requested style with professional-level rhythmic patterns, realistic phrasing, and tasteful ornamentation.
+3. Use proper voice leading and maintain cohesive thematic development.
+4. Include dynamics (mp, mf, f), crescendos/decrescendos (<! !>), and articulations (staccato, legato, accents).
+5. Add appropriate slurs and expression marks to enhance musicality.
+6. Follow the requested song form. Mark each section clearly in the ABC (e.g., [I:Intro], [V:Verse], [C:Chorus]).
+7. Establish a memorable melodic theme for verses and a catchy, dynamic hook for choruses.
+8. Use repetition and variation to create coherence, and slight rhythmic complexity for interest.
+9. Write exactly the requested number of measures.
+10. Use the requested key.
+11. Use the requested time signature.
+12. Include M:, L:, and K: headers as the first three lines after X:1.
+13. Output ONLY valid ABC notation with no additional text.
+14. For drum parts, use only these notes: B (bass), S (snare), H (hi-hat), O (open hi-hat), C (crash), R (ride).
+"""
+
+SETUP_SYSTEM_PROMPT = """You are a professional music theorist, composer and arranger for a polished, radio-ready production. Analyze the user's prompt and call BOTH tools exactly once:
+
+- set_musical_parameters: the tempo (90-140), time signature, key, number of measures (64-128), standard song form (sections joined by '-'), chord progression, scale and style.
+- set_instruments: instrument groups, each a list of {name, channel} entries with a 1-based MIDI channel. Groups rhythm, harmony and lead are required; accompaniment and backing_vocals are optional. Available instruments: DrumSet, ElectricBass, Piano, SynthLead, Violin, VoiceOohs. DrumSet must always use channel 10.
+"""
+
+INSTRUMENT_NAMES = ('DrumSet', 'ElectricBass', 'Piano', 'SynthLead', 'Violin', 'VoiceOohs')
+REQUIRED_INSTRUMENT_GROUPS = ('rhythm', 'harmony', 'lead')
+
+_INSTRUMENT_GROUP_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "name": {"type": "string", "enum": list(INSTRUMENT_NAMES)},
+            "channel": {"type": "integer", "minimum": 1, "maximum": 16}
+        },
+        "required": ["name", "channel"]
+    }
+}
+
+SETUP_TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "set_musical_parameters",
+            "description": "Set the global musical parameters of the song.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "tempo": {"type": "integer"},
+                    "time_signature": {"type": "string"},
+                    "key": {"type": "string"},
+                    "measures": {"type": "integer"},
+                    "form": {"type": "string"},
+                    "chord_progression": {"type": "array", "items": {"type": "string"}},
+                    "scale": {"type": "string"},
+                    "style": {"type": "string"}
+                },
+                "required": ["tempo", "time_signature", "key", "measures", "form",
+                             "chord_progression", "scale", "style"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "set_instruments",
+            "description": "Set the instrument groups and their MIDI channels.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "rhythm": _INSTRUMENT_GROUP_SCHEMA,
+                    "harmony": _INSTRUMENT_GROUP_SCHEMA,
+                    "lead": _INSTRUMENT_GROUP_SCHEMA,
+                    "accompaniment": _INSTRUMENT_GROUP_SCHEMA,
+                    "backing_vocals": _INSTRUMENT_GROUP_SCHEMA
+                },
+                "required": list(REQUIRED_INSTRUMENT_GROUPS)
+            }
+        }
+    }
+]
+
+@dataclass(slots=True, frozen=True)
+class MusicalParameters:
+    tempo: int
+    time_signature: str
+    key: str
+    measures: int
+    form: str
+    chord_progression: Tuple[str, ...]
+    scale: str
+    style: str
+
+async def determine_musical_parameters(prompt: str) -> MusicalParameters:
     try:
-        response = client.chat.completions.create(
+        raw_response = await _cached_chat(
             model='gpt-4o-mini',
             messages=[
-                {"role": "system", "content": system_prompt},
+                {"role": "system", "content": PARAMETERS_SYSTEM_PROMPT},
                 {"role": "user", "content": prompt}
             ],
+            semantic=True,
             max_tokens=500,
             temperature=0.5,
-            top_p=0.9,
         )
 
-        raw_response = response.choices[0].message.content.strip()
+        raw_response = raw_response.strip()
         logging.debug(f"Raw GPT response: {raw_response}")
 
         try:
-            params = json.loads(raw_response)
-        except json.JSONDecodeError:
+            params = orjson.loads(raw_response)
+        except orjson.JSONDecodeError:
             logging.error(f"Invalid JSON response: {raw_response}")
             return get_default_parameters()
 
@@ -63,65 +356,87 @@ Return ONLY a valid JSON object with these parameters (no comments):
         logging.error(f"Error determining musical parameters: {e}")
         return get_default_parameters()
 
-def get_default_parameters() -> Dict[str, Any]:
-    return {
-        'tempo': 120,
-        'time_signature': '4/4',
-        'key': 'C',
-        'measures': 64,
-        'form': 'Intro-Verse-Chorus-Verse-Chorus-Bridge-Chorus-Outro',
-        'chord_progression': ['C', 'G', 'Am', 'F'],
-        'scale': 'major',
-        'style': 'pop'
-    }
-
-def validate_parameters(params: Dict[str, Any]) -> Dict[str, Any]:
+def get_default_parameters() -> MusicalParameters:
+    return MusicalParameters(
+        tempo=120,
+        time_signature='4/4',
+        key='C',
+        measures=64,
+        form='Intro-Verse-Chorus-Verse-Chorus-Bridge-Chorus-Outro',
+        chord_progression=('C', 'G', 'Am', 'F'),
+        scale='major',
+        style='pop'
+    )
+
+def _str_param(params: Dict[str, Any], name: str, default: str) -> str:
+    # MusicalParameters is hashed by lru_cache, so every field must be a plain string
+    value = params.get(name, default)
+    return value if isinstance(value, str) and value.strip() else default
+
+def validate_parameters(params: Dict[str, Any]) -> MusicalParameters:
     defaults = get_default_parameters()
-    return {
-        'tempo': max(90, min(params.get('tempo', defaults['tempo']), 140)),
-        'time_signature': params.get('time_signature', defaults['time_signature']),
-        'key': params.get('key', defaults['key']),
-        'measures': max(64, min(params.get('measures', defaults['measures']), 128)),
-        'form': params.get('form', defaults['form']),
-        'chord_progression': params.get('chord_progression', defaults['chord_progression']),
-        'scale': params.get('scale', defaults['scale']),
-        'style': params.get('style', defaults['style'])
-    }
-
-def generate_music(prompt: str, params: Dict[str, Any]) -> Optional[str]:
-    system_prompt = f"""You are a professional music composer creating valid ABC notation for a polished, radio-ready song. Follow these requirements strictly:
-
-1. Compose music that follows the {params['scale']} scale and the given chord progression.
-2. Style: {params['style']} with professional-level rhythmic patterns, realistic phrasing, and tasteful ornamentation.
-3. Use proper voice leading and maintain cohesive thematic development.
-4. Include dynamics (mp, mf, f), crescendos/decrescendos (<! !>), and articulations (staccato, legato, accents).
-5. Add appropriate slurs and expression marks to enhance musicality.
-6. The song form: {params['form']}. Mark each section clearly in the ABC (e.g., [I:Intro], [V:Verse], [C:Chorus]).
-7. Establish a memorable melodic theme for verses and a catchy, dynamic hook for choruses.
-8. Use repetition and variation to create coherence, and slight rhythmic complexity for interest.
-9. Exactly {params['measures']} measures.
-10. Key: {params['key']}.
-11. Time Signature: {params['time_signature']}.
-12. Include M:, L:, and K: headers as the first three lines after X:1.
-13. Output ONLY valid ABC notation with no additional text.
-14. For drum parts, use only these notes: B (bass), S (snare), H (hi-hat), O (open hi-hat), C (crash), R (ride).
-"""
+    chord_progression = params.get('chord_progression', defaults.chord_progression)
+    if isinstance(chord_progression, (list, tuple)) and chord_progression:
+        chord_progression = tuple(str(c) for c in chord_progression)
+    else:
+        chord_progression = defaults.chord_progression
+    return MusicalParameters(
+        tempo=int(max(90, min(params.get('tempo', defaults.tempo), 140))),
+        time_signature=_str_param(params, 'time_signature', defaults.time_signature),
+        key=_str_param(params, 'key', defaults.key),
+        measures=int(max(64, min(params.get('measures', defaults.measures), 128))),
+        form=_str_param(params, 'form', defaults.form),
+        chord_progression=chord_progression,
+        scale=_str_param(params, 'scale', defaults.scale),
+        style=_str_param(params, 'style', defaults.style)
+    )
+
+NON_ABC_WORDS = ["sorry", "apologize", "here is", "here are"]
+
+def _contains_non_abc(text: str) -> bool:
+    text = text.lower()
+    return any(word in text for word in NON_ABC_WORDS)
+
+# A word split across deltas starts at most this many characters before the new delta
+_NON_ABC_LOOKBACK = max(len(word) for word in NON_ABC_WORDS) - 1
+
+@lru_cache(maxsize=32)
+def _song_prompt(params: MusicalParameters) -> str:
+    # Song-specific details go last so the static prefix stays cacheable server-side
+    return (
+        f"Scale: {params.scale}\n"
+        f"Style: {params.style}\n"
+        f"Song form: {params.form}\n"
+        f"Measures: {params.measures}\n"
+        f"Key: {params.key}\n"
+        f"Time Signature: {params.time_signature}"
+    )
+
+# Completion budget per instrument, sized from observed ABC output lengths
+_MAX_TOKENS = {'DrumSet': 600}
+_DEFAULT_MAX_TOKENS = 800
+
+async def generate_music(prompt: str, params: MusicalParameters, max_tokens: int = _DEFAULT_MAX_TOKENS) -> Optional[str]:
+    song_prompt = _song_prompt(params)
 
     try:
-        response = client.chat.completions.create(
+        raw_response = await _cached_chat(
             model='gpt-4o-mini',
             messages=[
-                {"role": "system", "content": system_prompt},
+                {"role": "system", "content": MUSIC_SYSTEM_PROMPT},
+                {"role": "system", "content": song_prompt},
                 {"role": "user", "content": prompt}
             ],
-            max_tokens=1000,
+            stop_when=_contains_non_abc,
+            stop_lookback=_NON_ABC_LOOKBACK,
+            max_tokens=max_tokens,
             temperature=0.7,
-            top_p=0.9,
+            stop=["\n\n\n"],
         )
 
-        content = response.choices[0].message.content.strip()
+        content = raw_response.strip()
 
-        if any(word in content.lower() for word in ["sorry", "apologize", "here is", "here are"]):
+        if _contains_non_abc(content):
             logging.warning("GPT response contains non-ABC content.")
             return None
 
@@ -131,50 +446,191 @@ def generate_music(prompt: str, params: Dict[str, Any]) -> Optional[str]:
         logging.error(f"Error in generate_music: {e}")
         return None
 
+_ABC_FLAT_TO_B = str.maketrans('_', 'b')
+_ABC_HEADER_PREFIXES = ('M:', 'L:', 'K:', 'X:', 'T:', 'V:', '%%')
+_ABC_REPEAT_RE = re.compile(r':\|:?|\|:')
+
 def clean_abc(abc_notation: str) -> str:
-    abc_notation = abc_notation.replace('_', 'b')
-    lines = abc_notation.strip().split('\n')
     cleaned_lines = []
-    for line in lines:
+    for line in abc_notation.translate(_ABC_FLAT_TO_B).strip().split('\n'):
         line = line.strip()
-        if line.startswith(('M:', 'L:', 'K:', 'X:', 'T:', 'V:', '%%')):
-            cleaned_lines.append(line)
-            continue
-        if '|' in line:
-            if not line.startswith('|'):
+        if '|' in line and not line.startswith(_ABC_HEADER_PREFIXES):
+            if line[0] != '|':
                 line = '|' + line
-            if not line.endswith('|'):
+            if line[-1] != '|':
                 line = line + '|'
         cleaned_lines.append(line)
 
-    abc_notation = '\n'.join(cleaned_lines)
-    abc_notation = abc_notation.replace(':|', '|').replace('|:', '|')
-    return abc_notation
+    return _ABC_REPEAT_RE.sub('|', '\n'.join(cleaned_lines))
+
+# Tokenizer for the narrow ABC subset the models produce: notes, rests, chords,
+# ties, broken rhythms and tuplets. Chord symbols, decorations, grace notes and
+# inline fields are dropped.
+_ABC_SKIP_RE = re.compile(r'"[^"]*"|![^!]*!|\+[^+]*\+|\{[^}]*\}|\[[A-Za-z]:[^\]]*\]')
+_ABC_TOKEN_RE = re.compile(
+    r"(?P<bar>\|)"
+    r"|\((?P<tuplet>[2-9])"
+    r"|\[(?P<chord>[^\]:|]*)\](?P<chord_len>\d*/*\d*)"
+    r"|(?:(?P<acc>\^\^|\^|__|_|=)?(?P<step>[A-Ga-g])(?P<oct>[,']*)|(?P<rest>[zx]))(?P<len>\d*/*\d*)"
+    r"|(?P<tie>-)"
+    r"|(?P<broken>[<>]+)"
+)
+_ABC_NOTE_RE = re.compile(r"(?P<acc>\^\^|\^|__|_|=)?(?P<step>[A-Ga-g])(?P<oct>[,']*)(?P<len>\d*/*\d*)")
+_ABC_ACCIDENTALS = {'^^': 2, '^': 1, '=': 0, '_': -1, '__': -2}
+_ABC_MODES = {
+    'm': 'minor', 'min': 'minor', 'maj': 'major', 'ion': 'ionian', 'aeo': 'aeolian',
+    'dor': 'dorian', 'phr': 'phrygian', 'lyd': 'lydian', 'mix': 'mixolydian', 'loc': 'locrian'
+}
+# ABC's default tuplet ratios: (p notes in the time of q
+_ABC_TUPLET_Q = {2: 3, 3: 2, 4: 3, 6: 2, 8: 3}
+
+def _abc_length(token: str, unit: Fraction) -> Fraction:
+    digits = re.match(r'(\d*)(/*)(\d*)', token)
+    num = int(digits.group(1)) if digits.group(1) else 1
+    if digits.group(2):
+        den = int(digits.group(3)) if digits.group(3) else 2 ** len(digits.group(2))
+    else:
+        den = 1
+    return unit * Fraction(num, den)
+
+def _abc_key(key_str: str) -> Optional[key.Key]:
+    m = re.match(r'\s*([A-Ga-g])([#b]?)\s*([A-Za-z]*)', key_str)
+    if not m:
+        return None
+    tonic = m.group(1).upper() + {'#': '#', 'b': '-'}.get(m.group(2), '')
+    mode = _ABC_MODES.get(m.group(3).lower()[:3], 'major') if m.group(3) else 'major'
+    try:
+        return key.Key(tonic, mode)
+    except Exception:
+        return None
+
+def parse_abc(abc_data: str) -> stream.Part:
+    # Lightweight replacement for converter.parseData(..., format='abc') that
+    # emits notes, rests and chords directly instead of running the full ABC grammar.
+    part = stream.Part()
+    unit = Fraction(1, 2)  # L:1/8 in quarter lengths
+    key_alters: Dict[str, int] = {}
+    body_lines = []
+
+    for line in abc_data.split('\n'):
+        line = line.strip()
+        if not line or line.startswith('%'):
+            continue
+        if len(line) > 1 and line[1] == ':' and line[0].isalpha():
+            field, value = line[0], line[2:].strip()
+            if field == 'L':
+                try:
+                    unit = Fraction(value) * 4
+                except (ValueError, ZeroDivisionError):
+                    pass
+            elif field == 'M':
+                try:
+                    part.insert(0, meter.TimeSignature(value))
+                except Exception:
+                    pass
+            elif field == 'K':
+                song_key = _abc_key(value)
+                if song_key is not None:
+                    part.insert(0, song_key)
+                    key_alters = {p.step: int(p.alter) for p in song_key.alteredPitches}
+            continue
+        body_lines.append(line)
+
+    def make_pitch(acc: Optional[str], step: str, octave_marks: str, bar_alters: Dict[Tuple[str, int], int]) -> pitch.Pitch:
+        p = pitch.Pitch()
+        p.step = step.upper()
+        p.octave = (5 if step.islower() else 4) + octave_marks.count("'") - octave_marks.count(',')
+        if acc is not None:
+            bar_alters[(p.step, p.octave)] = _ABC_ACCIDENTALS[acc]
+        alter = bar_alters.get((p.step, p.octave), key_alters.get(p.step, 0))
+        if alter:
+            p.accidental = alter
+        return p
+
+    offset = Fraction(0)
+    elements = []
+    bar_alters: Dict[Tuple[str, int], int] = {}
+    tuplet_left, tuplet_factor = 0, Fraction(1)
+    broken_next = Fraction(1)
+    tie_pending = False
+
+    for m in _ABC_TOKEN_RE.finditer(_ABC_SKIP_RE.sub('', ' '.join(body_lines))):
+        if m.group('bar'):
+            bar_alters = {}
+            continue
+        if m.group('tuplet'):
+            p_notes = int(m.group('tuplet'))
+            tuplet_left, tuplet_factor = p_notes, Fraction(_ABC_TUPLET_Q.get(p_notes, 2), p_notes)
+            continue
+        if m.group('tie'):
+            if elements and not isinstance(elements[-1], note.Rest):
+                elements[-1].tie = tie.Tie('start')
+                tie_pending = True
+            continue
+        if m.group('broken'):
+            if elements:
+                dots = len(m.group('broken'))
+                shift = 1 - Fraction(1, 2 ** dots)
+                prev = elements[-1]
+                old_length = Fraction(prev.quarterLength)
+                sign = 1 if m.group('broken')[0] == '>' else -1
+                prev.quarterLength = old_length * (1 + sign * shift)
+                broken_next = 1 - sign * shift
+                offset += Fraction(prev.quarterLength) - old_length
+            continue
+
+        if m.group('chord') is not None:
+            chord_notes = list(_ABC_NOTE_RE.finditer(m.group('chord')))
+            if not chord_notes:
+                continue
+            pitches = [make_pitch(n.group('acc'), n.group('step'), n.group('oct'), bar_alters) for n in chord_notes]
+            length = _abc_length(m.group('chord_len') or chord_notes[0].group('len'), unit)
+            elem = chord.Chord(pitches)
+        elif m.group('rest'):
+            length = _abc_length(m.group('len'), unit)
+            elem = note.Rest()
+        else:
+            length = _abc_length(m.group('len'), unit)
+            elem = note.Note(make_pitch(m.group('acc'), m.group('step'), m.group('oct'), bar_alters))
+
+        if tuplet_left:
+            length *= tuplet_factor
+            tuplet_left -= 1
+        length *= broken_next
+        broken_next = Fraction(1)
+        if tie_pending and not isinstance(elem, note.Rest):
+            elem.tie = tie.Tie('stop')
+        tie_pending = False
+
+        elem.quarterLength = length
+        elements.append(elem)
+        part.coreInsert(common.opFrac(offset), elem)
+        offset += length
+
+    part.coreElementsChanged()
+    return part
+
+# Use instrumentFromMidiProgram to ensure compatibility
+# Choir Aahs is program 52, as per GM spec.
+# If you want a simple instrument for now, just pick a known one:
+# For example, for VoiceOohs, we use Choir Aahs (GM #52)
+_INSTR_FACTORIES: Dict[str, Callable[[], instrument.Instrument]] = {
+    'Piano': instrument.Piano,
+    'Violin': instrument.Violin,
+    'ElectricBass': instrument.ElectricBass,
+    'DrumSet': instrument.UnpitchedPercussion,
+    'SynthLead': lambda: instrument.instrumentFromMidiProgram(80),  # Lead 1 (square)
+    'VoiceOohs': lambda: instrument.instrumentFromMidiProgram(52)    # Choir Aahs
+}
 
 def get_instrument_by_name(instr_name: str) -> instrument.Instrument:
-    # Use instrumentFromMidiProgram to ensure compatibility
-    # Choir Aahs is program 52, as per GM spec.
-    # If you want a simple instrument for now, just pick a known one:
-    # For example, for VoiceOohs, we use Choir Aahs (GM #52)
-    instr_map = {
-        'Piano': instrument.Piano(),
-        'Violin': instrument.Violin(),
-        'ElectricBass': instrument.ElectricBass(),
-        'DrumSet': instrument.UnpitchedPercussion(),
-        'SynthLead': instrument.instrumentFromMidiProgram(80),  # Lead 1 (square)
-        'VoiceOohs': instrument.instrumentFromMidiProgram(52)    # Choir Aahs
-    }
-    return instr_map.get(instr_name, instrument.Piano())
+    # Only the requested instrument is instantiated; callers mutate it, so no sharing
+    return _INSTR_FACTORIES.get(instr_name, instrument.Piano)()
 
-def create_part_from_abc(abc_notation: str, instr_name: str, channel: int, params: Dict[str, Any]) -> Optional[stream.Part]:
+def create_part_from_abc(abc_notation: str, instr_name: str, channel: int, params: MusicalParameters) -> Optional[stream.Part]:
     try:
-        headers = [
-            'X:1',
-            f'M:{params["time_signature"]}',
-            'L:1/8',
-            f'K:{params["key"]}'
-        ]
-        
+        headers = f'X:1\nM:{params.time_signature}\nL:1/8\nK:{params.key}'
+
         content_lines = []
         for line in abc_notation.split('\n'):
             line = line.strip()
@@ -189,12 +645,12 @@ def create_part_from_abc(abc_notation: str, instr_name: str, channel: int, param
                 if '|' in filtered_line:
                     content_lines.append(filtered_line)
 
-        abc_data = '\n'.join(headers + content_lines)
+        abc_data = '\n'.join([headers] + content_lines)
         
         if instr_name == 'DrumSet':
             return create_drum_part(abc_data, channel)
 
-        temp_stream = converter.parseData(abc_data, format='abc')
+        temp_stream = parse_abc(abc_data)
         part = stream.Part()
         part.id = instr_name
         
@@ -202,18 +658,22 @@ def create_part_from_abc(abc_notation: str, instr_name: str, channel: int, param
         instr.midiChannel = channel
         part.insert(0, instr)
 
-        for elem in temp_stream.recurse():
-            part.append(deepcopy(elem))
+        # temp_stream is discarded, so its elements are moved over without copying
+        for elem in temp_stream.getElementsByClass(['TimeSignature', 'KeySignature']):
+            part.insert(0, elem)
+        for elem in temp_stream.notesAndRests:
+            part.append(elem)
 
         if not part.hasMeasures():
             part.makeMeasures(inPlace=True)
 
-        notes = list(part.recurse().getElementsByClass(['Note', 'Rest']))
-        if not notes:
+        notes_and_rests = list(part.recurse().notesAndRests)
+        if not notes_and_rests:
             return None
 
-        for note_obj in part.recurse().notes:
-            note_obj.volume.velocity = random.randint(65, 85)
+        for note_obj in notes_and_rests:
+            if not note_obj.isRest:
+                note_obj.volume.velocity = random.randint(65, 85)
 
         return part
 
@@ -223,7 +683,7 @@ def create_part_from_abc(abc_notation: str, instr_name: str, channel: int, param
 
 def create_drum_part(abc_notation: str, channel: int) -> Optional[stream.Part]:
     try:
-        part = converter.parseData(abc_notation, format='abc')
+        part = parse_abc(abc_notation)
         drum_part = stream.Part()
         drum_part.id = 'DrumSet'
         
@@ -231,7 +691,7 @@ def create_drum_part(abc_notation: str, channel: int) -> Optional[stream.Part]:
         instr.midiChannel = channel
         drum_part.insert(0, instr)
 
-        for elem in part.flatten().notesAndRests:
+        for elem in part.notesAndRests:
             drum_part.append(elem)
 
         return process_drum_part(drum_part)
@@ -240,61 +700,55 @@ def create_drum_part(abc_notation: str, channel: int) -> Optional[stream.Part]:
         logging.error(f"Error creating drum part: {e}")
         return None
 
-def process_drum_part(part: stream.Part) -> stream.Part:
-    percussion_map = {
-        'C': 36,
-        'D': 38,
-        'E': 42,
-        'F': 46,
-        'G': 49,
-        'A': 51,
-        'B': 53,
-        'z': 0
-    }
-    for note_obj in part.recurse().notes:
-        pitch_name = note_obj.pitch.name.upper()
-        midi_number = percussion_map.get(pitch_name, 35)  
-        note_obj.pitch.midi = midi_number
-    return part
-
-def determine_instruments(prompt: str) -> Dict[str, Any]:
-    system_prompt = """You are a music arranger for a polished, radio-ready production. Analyze the prompt and choose appropriate instruments to create a rich, balanced track.
-
-Return ONLY a valid JSON object with instrument groups and their MIDI channels. Format:
-{
-    "rhythm": [["DrumSet", 10], ["ElectricBass", 1]],
-    "harmony": [["Piano", 2]],
-    "lead": [["SynthLead", 3]],
-    "accompaniment": [["Violin", 4]],
-    "backing_vocals": [["VoiceOohs", 5]]
+_PERCUSSION_MAP = {
+    'C': 36,
+    'D': 38,
+    'E': 42,
+    'F': 46,
+    'G': 49,
+    'A': 51,
+    'B': 53,
+    'z': 0
 }
 
-DrumSet must always use channel 10.
-"""
+# 128-entry lookup table from ABC note letter (ASCII code) to GM percussion key;
+# anything else, including accidentals, falls back to 35 (Acoustic Bass Drum)
+_PERCUSSION_LUT = np.full(128, 35, dtype=np.uint8)
+_PERCUSSION_LUT[[ord(name) for name in _PERCUSSION_MAP]] = list(_PERCUSSION_MAP.values())
+
+def process_drum_part(part: stream.Part) -> stream.Part:
+    pitches = [p for note_obj in part.recurse().notes for p in note_obj.pitches]
+    if not pitches:
+        return part
+    codes = np.fromiter((ord(p.name) if len(p.name) == 1 else 0 for p in pitches),
+                        dtype=np.uint8, count=len(pitches))
+    for p, midi_number in zip(pitches, _PERCUSSION_LUT[codes].tolist()):
+        p.midi = midi_number
+    return part
 
+async def determine_instruments(prompt: str) -> Dict[str, Any]:
     try:
-        response = client.chat.completions.create(
+        raw_response = await _cached_chat(
             model='gpt-4o-mini',
             messages=[
-                {"role": "system", "content": system_prompt},
+                {"role": "system", "content": INSTRUMENTS_SYSTEM_PROMPT},
                 {"role": "user", "content": prompt}
             ],
+            semantic=True,
             max_tokens=500,
             temperature=0.5,
-            top_p=0.9,
         )
 
-        raw_response = response.choices[0].message.content.strip()
+        raw_response = raw_response.strip()
         cleaned_response = '\n'.join([line for line in raw_response.split('\n') 
                                       if not line.strip().startswith('//')])
         try:
-            instrument_groups = json.loads(cleaned_response)
-            required_groups = ['rhythm', 'harmony', 'lead']
-            if not all(group in instrument_groups for group in required_groups):
-                logging.warning("Missing required instrument groups, using defaults")
+            instrument_groups = validate_instruments(orjson.loads(cleaned_response))
+            if instrument_groups is None:
+                logging.warning("Missing or malformed instrument groups, using defaults")
                 return get_default_instruments()
             return instrument_groups
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
             logging.error("Invalid JSON response for instruments")
             return get_default_instruments()
 
@@ -302,6 +756,32 @@ DrumSet must always use channel 10.
         logging.error(f"Error determining instruments: {e}")
         return get_default_instruments()
 
+def validate_instruments(groups: Any) -> Optional[Dict[str, List[List[Any]]]]:
+    # Accepts [name, channel] pairs or {"name", "channel"} objects and normalizes
+    # them to [str, int] pairs; returns None when a required group is missing
+    if not isinstance(groups, dict):
+        return None
+    validated = {}
+    for group, entries in groups.items():
+        if not isinstance(entries, list):
+            continue
+        pairs = []
+        for entry in entries:
+            if isinstance(entry, dict):
+                entry = [entry.get('name'), entry.get('channel')]
+            if not isinstance(entry, (list, tuple)) or len(entry) != 2 or not isinstance(entry[0], str):
+                continue
+            try:
+                channel = int(entry[1])
+            except (TypeError, ValueError):
+                continue
+            if 1 <= channel <= 16:
+                pairs.append([entry[0], channel])
+        validated[str(group)] = pairs
+    if not all(group in validated for group in REQUIRED_INSTRUMENT_GROUPS):
+        return None
+    return validated
+
 def get_default_instruments() -> Dict[str, Any]:
     return {
         "rhythm": [["DrumSet", 10], ["ElectricBass", 1]],
@@ -311,16 +791,84 @@ def get_default_instruments() -> Dict[str, Any]:
         "backing_vocals": [["VoiceOohs", 5]]
     }
 
-def generate_part(user_prompt: str, instr: str, channel: int, params: Dict[str, Any]) -> Optional[stream.Part]:
+async def determine_song_setup(prompt: str) -> Tuple[MusicalParameters, Dict[str, Any]]:
+    # One tool-calling round-trip returns both parameters and instruments;
+    # anything unexpected falls back to the two dedicated calls, run concurrently.
+    try:
+        raw_response = await _cached_chat(
+            model='gpt-4o-mini',
+            messages=[
+                {"role": "system", "content": SETUP_SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ],
+            semantic=True,
+            tools=SETUP_TOOLS,
+            tool_choice="required",
+            max_tokens=800,
+            temperature=0.5,
+        )
+
+        tool_args = orjson.loads(raw_response)
+        params = orjson.loads(tool_args['set_musical_parameters'])
+        instrument_groups = validate_instruments(orjson.loads(tool_args['set_instruments']))
+
+        if not isinstance(params, dict) or instrument_groups is None:
+            raise ValueError("tool call arguments do not match the expected schema")
+
+        return validate_parameters(params), instrument_groups
+
+    except Exception as e:
+        logging.warning(f"Combined setup call failed ({e}), falling back to separate requests")
+        params, instrument_groups = await asyncio.gather(
+            determine_musical_parameters(prompt),
+            determine_instruments(prompt)
+        )
+        return params, instrument_groups
+
+VERSE_WORDS = ("verse",)
+CHORUS_WORDS = ("chorus", "hook")
+BRIDGE_WORDS = ("bridge", "pre-chorus")
+
+def _classify_section(section: str) -> Tuple[int, Tuple[int, int]]:
+    # (weight, (vel_min, vel_max)); weight is the relative share of the song's
+    # measures: choruses run longest, intros/outros shortest
+    section = section.lower()
+    if any(s in section for s in VERSE_WORDS):
+        return 4, (60, 75)
+    if any(s in section for s in CHORUS_WORDS):
+        return 5, (80, 100)
+    if any(s in section for s in BRIDGE_WORDS):
+        return 3, (70, 85)
+    if 'intro' in section or 'outro' in section:
+        return 2, (65, 85)
+    return 3, (65, 85)
+
+@lru_cache(maxsize=32)
+def section_velocity_ranges(form: str, total_measures: int) -> np.ndarray:
+    # (measures, 2) array of (vel_min, vel_max) per measure, computed once per song
+    sections = form.lower().split('-')
+    total_measures = max(total_measures, 1)
+    classified = [_classify_section(s) for s in sections]
+    weights = np.array([w for w, _ in classified], dtype=np.int64)
+    section_ranges = np.array([r for _, r in classified], dtype=np.int64)
+    # End measure of each section; rounding leftovers fall into the last section
+    bounds = np.cumsum(weights * total_measures // weights.sum())
+    section_idx = np.searchsorted(bounds, np.arange(total_measures), side='right')
+    per_measure = section_ranges[np.minimum(section_idx, len(sections) - 1)]
+    per_measure.flags.writeable = False
+    return per_measure
+
+async def generate_part(user_prompt: str, instr: str, channel: int, params: MusicalParameters) -> Optional[Tuple[stream.Part, int]]:
+    # Returns the part with its note/rest count so callers need not walk it again
     if instr == 'DrumSet':
         instrument_prompt = (
-            f"Craft {params['measures']} measures of professional drum patterns in {params['time_signature']} for a {params['style']} style song, following {params['chord_progression']} and {params['form']}. "
+            f"Craft {params.measures} measures of professional drum patterns in {params.time_signature} for a {params.style} style song, following {list(params.chord_progression)} and {params.form}. "
             "Use tasteful variations, realistic fills, and appropriate dynamics. Only use B,S,H,O,C,R notes."
         )
     else:
         base_prompt = (
-            f"Craft {params['measures']} measures of a {instr} part for a {params['style']} song. "
-            f"Key: {params['key']}, Time: {params['time_signature']}, Form: {params['form']} with chord progression {params['chord_progression']}. "
+            f"Craft {params.measures} measures of a {instr} part for a {params.style} song. "
+            f"Key: {params.key}, Time: {params.time_signature}, Form: {params.form} with chord progression {list(params.chord_progression)}. "
             "Include dynamics, articulations, and tasteful melodic/harmonic content. Make the result professional, cohesive, and radio-ready."
         )
 
@@ -329,7 +877,7 @@ def generate_part(user_prompt: str, instr: str, channel: int, params: Dict[str,
             "Ensure M:, L:, and K: headers are present at the start, and produce ONLY ABC notation."
         )
 
-    abc_notation = generate_music(instrument_prompt, params)
+    abc_notation = await generate_music(instrument_prompt, params, _MAX_TOKENS.get(instr, _DEFAULT_MAX_TOKENS))
     if not abc_notation:
         logging.warning(f"No ABC notation generated for {instr}")
         return None
@@ -354,71 +902,77 @@ def generate_part(user_prompt: str, instr: str, channel: int, params: Dict[str,
     if not part:
         logging.warning(f"Failed to create part for {instr}")
         return None
-    if instr == 'DrumSet':
-        part = process_drum_part(part)
 
-    notes = list(part.recurse().getElementsByClass(['Note', 'Rest']))
-    if not notes:
+    notes_and_rests = list(part.recurse().notesAndRests)
+    if not notes_and_rests:
         logging.warning(f"No notes found in part for {instr}")
         return None
 
     # Section-based velocity shaping
-    form = params['form'].lower()
-    verse_words = ["verse"]
-    chorus_words = ["chorus", "hook"]
-    bridge_words = ["bridge", "pre-chorus"]
-    total_measures = params['measures']
-    sections = form.split('-')
-    section_len = max(1, total_measures // len(sections))
-    measure_count = 0
-
-    for m in part.getElementsByClass('Measure'):
-        current_section = sections[measure_count // section_len] if (measure_count // section_len) < len(sections) else sections[-1]
-        current_section_lower = current_section.lower()
-
-        if any(s in current_section_lower for s in verse_words):
-            vel_min, vel_max = 60, 75
-        elif any(s in current_section_lower for s in chorus_words):
-            vel_min, vel_max = 80, 100
-        elif any(s in current_section_lower for s in bridge_words):
-            vel_min, vel_max = 70, 85
-        else:
-            vel_min, vel_max = 65, 85
-
-        for n in m.notes:
-            n.volume.velocity = random.randint(vel_min, vel_max)
+    per_measure = section_velocity_ranges(params.form, params.measures)
+    shaped_notes = []
+    note_measures = []
+
+    for i, m in enumerate(part.getElementsByClass('Measure')):
+        measure_notes = list(m.notes)
+        shaped_notes.extend(measure_notes)
+        note_measures.extend([i] * len(measure_notes))
+
+    # Draw all velocities and timing jitter for the part in two bulk NumPy calls
+    if shaped_notes:
+        # Measures past the end of the form keep the last section's range
+        bounds = per_measure[np.minimum(note_measures, len(per_measure) - 1)]
+        velocities = np.random.randint(bounds[:, 0], bounds[:, 1] + 1).tolist()
+        jitter = np.random.uniform(-0.02, 0.02, size=len(shaped_notes)).tolist()
+        for n, v, j in zip(shaped_notes, velocities, jitter):
+            n.volume.velocity = v
             if n.offset is not None and n.offset > 0:
-                n.offset += random.uniform(-0.02, 0.02)
+                n.offset += j
 
-        measure_count += 1
+    return part, len(notes_and_rests)
 
-    return part
-
-def create_song(user_prompt: str) -> Optional[stream.Score]:
+async def create_song(user_prompt: str) -> Optional[stream.Score]:
     try:
-        global_parameters = determine_musical_parameters(user_prompt)
+        global_parameters, instrument_groups = await determine_song_setup(user_prompt)
         logging.info("\nSelected musical parameters:")
-        for param, value in global_parameters.items():
-            logging.info(f"{param}: {value}")
+        for field in fields(global_parameters):
+            logging.info(f"{field.name}: {getattr(global_parameters, field.name)}")
 
         score = stream.Score()
 
-        score.insert(0, tempo.MetronomeMark(number=global_parameters['tempo']))
-        score.insert(0, meter.TimeSignature(global_parameters['time_signature']))
+        score.insert(0, tempo.MetronomeMark(number=global_parameters.tempo))
+        score.insert(0, meter.TimeSignature(global_parameters.time_signature))
 
-        instrument_groups = determine_instruments(user_prompt)
         logging.info(f"\nSelected instruments: {instrument_groups}")
 
-        valid_parts = 0
-        for group, instruments_ in instrument_groups.items():
-            for instr_name, channel in instruments_:
+        # Fan out all instrument parts concurrently, bounded to respect rate limits
+        sem = asyncio.Semaphore(MAX_CONCURRENT_PARTS)
+
+        async def limited(group: str, instr_name: str, channel: int) -> Optional[Tuple[stream.Part, int]]:
+            async with sem:
                 logging.info(f"\nGenerating {instr_name} part ({group} group) on channel {channel}...")
-                part = generate_part(user_prompt, instr_name, channel, global_parameters)
-                if part and len(part.flatten().notesAndRests) > 0:
-                    if not part.hasMeasures():
-                        part.makeMeasures(inPlace=True)
-                    score.append(part)
-                    valid_parts += 1
+                return await generate_part(user_prompt, instr_name, channel, global_parameters)
+
+        tasks = [
+            limited(group, instr_name, channel)
+            for group, instruments_ in instrument_groups.items()
+            for instr_name, channel in instruments_
+        ]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+        valid_parts = 0
+        for result in results:
+            if isinstance(result, Exception):
+                logging.error(f"Error generating part: {result}")
+                continue
+            if not result:
+                continue
+            part, note_count = result
+            if note_count > 0:
+                if not part.hasMeasures():
+                    part.makeMeasures(inPlace=True)
+                score.append(part)
+                valid_parts += 1
 
         if valid_parts == 0:
             logging.error("No valid parts were generated!")
@@ -434,6 +988,77 @@ def create_song(user_prompt: str) -> Optional[stream.Score]:
         logging.error(f"Error generating song: {e}")
         return None
 
+# MIDI ticks per quarter note for files written by write_midi
+TICKS_PER_BEAT = 480
+
+def write_midi(score: stream.Score, midi_file: str) -> None:
+    # Emit a type-1 MIDI file straight from the score's notes with mido,
+    # bypassing music21's general-purpose MIDI translator.
+    mf = mido.MidiFile(type=1, ticks_per_beat=TICKS_PER_BEAT)
+
+    conductor = mido.MidiTrack()
+    mf.tracks.append(conductor)
+    metronome = score.recurse().getElementsByClass('MetronomeMark').first()
+    bpm = metronome.number if metronome is not None and metronome.number else 120
+    conductor.append(mido.MetaMessage('set_tempo', tempo=mido.bpm2tempo(bpm), time=0))
+    time_sig = score.recurse().getElementsByClass('TimeSignature').first()
+    if time_sig is not None:
+        conductor.append(mido.MetaMessage('time_signature', numerator=time_sig.numerator,
+                                          denominator=time_sig.denominator, time=0))
+
+    for part in score.parts:
+        # makeMeasures moves the instrument into the first measure
+        instr = part.recurse().getElementsByClass(instrument.Instrument).first()
+        # Channels in this script are 1-based GM channels (drums on 10)
+        channel = max(0, min((instr.midiChannel or 1) - 1, 15)) if instr is not None else 0
+        track = mido.MidiTrack()
+        mf.tracks.append(track)
+        track.append(mido.MetaMessage('track_name', name=str(part.id), time=0))
+        if instr is not None and instr.midiProgram is not None and channel != 9:
+            track.append(mido.Message('program_change', channel=channel, program=instr.midiProgram, time=0))
+
+        # [tick, is_note_on, midi, velocity]; tied continuations extend the open note_off
+        events = []
+        open_offs = {}
+        flat = part.flatten()
+        for n in flat.notes:
+            offset = float(flat.elementOffset(n))
+            start = max(0, round(offset * TICKS_PER_BEAT))
+            end = max(start + 1, round((offset + float(n.quarterLength)) * TICKS_PER_BEAT))
+            velocity = max(1, min(int(n.volume.velocity or 90), 127))
+            tie_type = n.tie.type if n.tie is not None else None
+            for p in n.pitches:
+                if tie_type in ('stop', 'continue') and p.midi in open_offs:
+                    open_offs[p.midi][0] = end
+                    continue
+                # A re-strike of a still-sounding pitch ends the earlier note first
+                previous_off = open_offs.get(p.midi)
+                if previous_off is not None and previous_off[0] > start:
+                    previous_off[0] = start
+                events.append([start, 1, p.midi, velocity])
+                note_off = [end, 0, p.midi, 0]
+                events.append(note_off)
+                open_offs[p.midi] = note_off
+
+        # note_off sorts before note_on at the same tick so re-struck notes are not cut short
+        events.sort(key=lambda e: (e[0], e[1]))
+        last_tick = 0
+        for tick, is_on, midi_number, velocity in events:
+            msg_type = 'note_on' if is_on else 'note_off'
+            track.append(mido.Message(msg_type, channel=channel, note=midi_number,
+                                      velocity=velocity, time=tick - last_tick))
+            last_tick = tick
+
+    mf.save(midi_file)
+
+async def run(user_prompt: str) -> Optional[stream.Score]:
+    async with _make_http_client() as http_client:
+        token = _run_client.set(AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'), http_client=http_client))
+        try:
+            return await create_song(user_prompt)
+        finally:
+            _run_client.reset(token)
+
 def main():
     try:
         user_song_prompt = input("Enter a prompt to generate your song: ")
@@ -441,10 +1066,10 @@ def main():
             logging.error("No prompt provided. Exiting.")
             return
 
-        song = create_song(user_song_prompt)
+        song = asyncio.run(run(user_song_prompt))
         if song:
             midi_file = 'generated_song.mid'
-            song.write('midi', fp=midi_file)
+            write_midi(song, midi_file)
             logging.info(f"MIDI file '{midi_file}' generated successfully!")
         else:
             logging.error("Failed to generate song - no valid content")
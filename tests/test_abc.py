@@ -0,0 +1,29 @@
+from music21 import converter, harmony
+
+import spotifAI
+
+ABC_SNIPPET = """X:1
+M:4/4
+L:1/8
+K:G
+|"G"G2 AB c2 d2|e>d ^c=c [GBd]4|(3efg a2- a4|"Em"_B,2 z2 F2 f2|"""
+
+
+def _events(s):
+    events = []
+    for elem in s.flatten().notesAndRests:
+        if isinstance(elem, harmony.ChordSymbol):
+            continue
+        pitches = 'rest' if elem.isRest else tuple(sorted(p.midi for p in elem.pitches))
+        events.append((round(float(elem.offset), 6), round(float(elem.quarterLength), 6), pitches))
+    return events
+
+
+def test_parse_abc_matches_music21():
+    assert _events(spotifAI.parse_abc(ABC_SNIPPET)) == _events(converter.parseData(ABC_SNIPPET, format='abc'))
+
+
+def test_parse_abc_skips_chord_symbols():
+    part = spotifAI.parse_abc('X:1\nM:4/4\nL:1/8\nK:C\n|"Am"c4 d4|')
+
+    assert [(float(n.offset), n.nameWithOctave) for n in part.notes] == [(0.0, 'C5'), (2.0, 'D5')]
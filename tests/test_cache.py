@@ -0,0 +1,80 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import spotifAI
+
+
+class FakeCompletions:
+    def __init__(self, content):
+        self.content = content
+        self.calls = 0
+
+    async def create(self, **kw):
+        self.calls += 1
+        message = SimpleNamespace(content=self.content, tool_calls=None)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+class FakeEmbeddings:
+    async def create(self, **kw):
+        return SimpleNamespace(data=[SimpleNamespace(embedding=[1.0, 0.0, 0.0])])
+
+
+@pytest.fixture
+def fake_client(monkeypatch, tmp_path):
+    completions = FakeCompletions('{"tempo": 100}')
+    client = SimpleNamespace(chat=SimpleNamespace(completions=completions), embeddings=FakeEmbeddings())
+    monkeypatch.setattr(spotifAI, 'client', client)
+    monkeypatch.setattr(spotifAI, 'CACHE_DIR', str(tmp_path))
+    return completions
+
+
+def _messages(text):
+    return [{"role": "system", "content": "sys"}, {"role": "user", "content": text}]
+
+
+def test_cached_chat_hits_disk_cache(fake_client):
+    first = asyncio.run(spotifAI._cached_chat('gpt-4o-mini', _messages('hi'), temperature=0.5))
+    second = asyncio.run(spotifAI._cached_chat('gpt-4o-mini', _messages('hi'), temperature=0.5))
+
+    assert first == second == '{"tempo": 100}'
+    assert fake_client.calls == 1
+
+
+def test_semantic_cache_reuses_similar_prompt(fake_client):
+    asyncio.run(spotifAI._cached_chat('gpt-4o-mini', _messages('upbeat pop song'), semantic=True))
+    reused = asyncio.run(spotifAI._cached_chat('gpt-4o-mini', _messages('a cheerful pop tune'), semantic=True))
+    # The original prompt must also have been written to the exact cache
+    asyncio.run(spotifAI._cached_chat('gpt-4o-mini', _messages('upbeat pop song'), semantic=True))
+
+    assert reused == '{"tempo": 100}'
+    assert fake_client.calls == 1
+
+
+def test_semantic_cache_respects_ttl(fake_client, monkeypatch):
+    asyncio.run(spotifAI._cached_chat('gpt-4o-mini', _messages('upbeat pop song'), semantic=True))
+    now = spotifAI.time.time()
+    monkeypatch.setattr(spotifAI.time, 'time', lambda: now + spotifAI.CACHE_TTL + 1)
+    asyncio.run(spotifAI._cached_chat('gpt-4o-mini', _messages('a cheerful pop tune'), semantic=True))
+
+    assert fake_client.calls == 2
+
+
+def test_semantic_cache_is_capped(fake_client, monkeypatch):
+    monkeypatch.setattr(spotifAI, 'SEMANTIC_MAX_ROWS', 2)
+    query = spotifAI.np.ones(3, dtype=spotifAI.np.float32)
+    for i in range(3):
+        spotifAI._semantic_store('ctx', query, f'answer {i}')
+
+    embs, rows = spotifAI._semantic_load('ctx')
+    assert [row['content'] for row in rows] == ['answer 1', 'answer 2']
+    assert embs.shape == (2, 3)
+
+
+def test_tool_request_answered_in_text_is_not_cached(fake_client):
+    for _ in range(2):
+        asyncio.run(spotifAI._cached_chat('gpt-4o-mini', _messages('hi'), tools=[{"type": "function"}]))
+
+    assert fake_client.calls == 2
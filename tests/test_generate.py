@@ -0,0 +1,62 @@
+import asyncio
+from types import SimpleNamespace
+
+import spotifAI
+
+
+class FakeStream:
+    def __init__(self, deltas):
+        self.deltas = deltas
+        self.closed = False
+
+    def __aiter__(self):
+        return self._iter()
+
+    async def _iter(self):
+        for delta in self.deltas:
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=delta))])
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeStreamingCompletions:
+    def __init__(self, deltas):
+        self.stream = FakeStream(deltas)
+
+    async def create(self, **kw):
+        assert kw['stream'] is True
+        return self.stream
+
+
+def _use_stream(monkeypatch, tmp_path, deltas):
+    completions = FakeStreamingCompletions(deltas)
+    monkeypatch.setattr(spotifAI, 'client', SimpleNamespace(chat=SimpleNamespace(completions=completions)))
+    monkeypatch.setattr(spotifAI, 'CACHE_DIR', str(tmp_path))
+    return completions.stream
+
+
+def test_generate_music_returns_streamed_abc(monkeypatch, tmp_path):
+    _use_stream(monkeypatch, tmp_path, ['X:1\nM:4/4\n', 'L:1/8\nK:C\n', '|C2 D2 E2 F2|'])
+
+    abc = asyncio.run(spotifAI.generate_music('piano part', spotifAI.get_default_parameters()))
+
+    assert abc == 'X:1\nM:4/4\nL:1/8\nK:C\n|C2 D2 E2 F2|'
+
+
+def test_generate_music_aborts_on_non_abc_reply(monkeypatch, tmp_path):
+    stream = _use_stream(monkeypatch, tmp_path, ['Sorry, ', 'I cannot ', 'write that.'])
+
+    abc = asyncio.run(spotifAI.generate_music('piano part', spotifAI.get_default_parameters()))
+
+    assert abc is None
+    assert stream.closed
+
+
+def test_generate_music_aborts_on_word_split_across_deltas(monkeypatch, tmp_path):
+    stream = _use_stream(monkeypatch, tmp_path, ['X:1\nK:C\n' * 50 + 'Here ', 'is your song'])
+
+    abc = asyncio.run(spotifAI.generate_music('piano part', spotifAI.get_default_parameters()))
+
+    assert abc is None
+    assert stream.closed
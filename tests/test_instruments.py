@@ -0,0 +1,27 @@
+import spotifAI
+
+
+def test_validate_instruments_normalizes_pairs_and_objects():
+    groups = spotifAI.validate_instruments({
+        "rhythm": [["DrumSet", 10], {"name": "ElectricBass", "channel": "1"}],
+        "harmony": [["Piano", "2"]],
+        "lead": [{"name": "SynthLead", "channel": 3}],
+    })
+
+    assert groups == {
+        "rhythm": [["DrumSet", 10], ["ElectricBass", 1]],
+        "harmony": [["Piano", 2]],
+        "lead": [["SynthLead", 3]],
+    }
+
+
+def test_validate_instruments_drops_bad_channels_and_rejects_missing_groups():
+    groups = spotifAI.validate_instruments({
+        "rhythm": [["DrumSet", "ten"], ["ElectricBass", 1]],
+        "harmony": [["Piano", 99]],
+        "lead": [["SynthLead", 3]],
+    })
+
+    assert groups["rhythm"] == [["ElectricBass", 1]]
+    assert groups["harmony"] == []
+    assert spotifAI.validate_instruments({"rhythm": [["DrumSet", 10]]}) is None
@@ -0,0 +1,67 @@
+import mido
+from music21 import note, stream, tempo
+
+import spotifAI
+
+
+def _part(instr_name, channel, midi_numbers):
+    part = stream.Part()
+    part.id = instr_name
+    instr = spotifAI.get_instrument_by_name(instr_name)
+    instr.midiChannel = channel
+    part.insert(0, instr)
+    for midi_number in midi_numbers:
+        part.append(note.Note(midi_number, quarterLength=1))
+    part.makeMeasures(inPlace=True)
+    return part
+
+
+def test_write_midi_keeps_channel_and_program_per_track(tmp_path):
+    score = stream.Score()
+    score.insert(0, tempo.MetronomeMark(number=110))
+    score.append(_part('ElectricBass', 1, [40, 43, 45, 47, 40]))
+    score.append(_part('Piano', 2, [60, 64, 67, 72, 60]))
+    score.append(_part('DrumSet', 10, [36, 38, 42, 38, 36]))
+
+    midi_file = tmp_path / 'song.mid'
+    spotifAI.write_midi(score, str(midi_file))
+
+    tracks = {}
+    for track in mido.MidiFile(str(midi_file)).tracks[1:]:
+        name = next(msg.name for msg in track if msg.type == 'track_name')
+        programs = [msg.program for msg in track if msg.type == 'program_change']
+        channels = {msg.channel for msg in track if msg.type == 'note_on'}
+        tracks[name] = (programs, channels)
+
+    assert tracks['ElectricBass'] == ([33], {0})
+    assert tracks['Piano'] == ([0], {1})
+    assert tracks['DrumSet'] == ([], {9})
+
+
+def test_write_midi_clips_overlapping_restrikes(tmp_path):
+    part = stream.Part()
+    part.id = 'Piano'
+    instr = spotifAI.get_instrument_by_name('Piano')
+    instr.midiChannel = 1
+    part.insert(0, instr)
+    # Jittered offsets make each C4 overlap the next by a few ticks
+    for offset in (0, 0.515, 0.985):
+        part.insert(offset, note.Note(60, quarterLength=0.5))
+    score = stream.Score()
+    score.append(part)
+
+    midi_file = tmp_path / 'song.mid'
+    spotifAI.write_midi(score, str(midi_file))
+
+    tick = 0
+    sounding = {}
+    lengths = []
+    for msg in mido.MidiFile(str(midi_file)).tracks[1]:
+        tick += msg.time
+        if msg.type == 'note_on' and msg.velocity > 0:
+            assert msg.note not in sounding
+            sounding[msg.note] = tick
+        elif msg.type in ('note_off', 'note_on'):
+            lengths.append(tick - sounding.pop(msg.note))
+
+    assert lengths == [240, 226, 240]
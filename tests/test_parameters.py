@@ -0,0 +1,22 @@
+import spotifAI
+
+
+def test_string_chord_progression_falls_back_to_default():
+    params = spotifAI.validate_parameters({'chord_progression': 'C-G-Am-F'})
+
+    assert params.chord_progression == spotifAI.get_default_parameters().chord_progression
+
+
+def test_nested_chord_progression_stays_hashable():
+    params = spotifAI.validate_parameters({'chord_progression': [['C', 'G'], ['Am', 'F']]})
+
+    assert all(isinstance(c, str) for c in params.chord_progression)
+    assert spotifAI._song_prompt(params)
+
+
+def test_non_string_fields_fall_back_to_defaults():
+    defaults = spotifAI.get_default_parameters()
+    params = spotifAI.validate_parameters({'form': ['Verse', 'Chorus'], 'key': None, 'style': {'a': 1}})
+
+    assert (params.form, params.key, params.style) == (defaults.form, defaults.key, defaults.style)
+    hash(params)
@@ -0,0 +1,22 @@
+import asyncio
+
+import spotifAI
+
+
+def test_run_can_be_called_repeatedly(monkeypatch):
+    seen = []
+
+    async def fake_create_song(user_prompt):
+        active = spotifAI._openai()
+        assert active is not spotifAI.client
+        assert not active._client.is_closed
+        seen.append(active)
+        return None
+
+    monkeypatch.setattr(spotifAI, 'create_song', fake_create_song)
+
+    asyncio.run(spotifAI.run('first'))
+    asyncio.run(spotifAI.run('second'))
+
+    assert len(seen) == 2 and seen[0] is not seen[1]
+    assert spotifAI._openai() is spotifAI.client